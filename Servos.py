@@ -6,6 +6,9 @@ import datetime
 import os.path
 import time
 import math
+import mmap
+import fcntl
+import struct
 import Adafruit_PCA9685
 
 # Robot02 servo variables
@@ -24,6 +27,21 @@ speeds = [[0.001, 0.001], [0.01, 0.001], [0.02, 0.001], [1, 0]]
 
 historyFileName = "history"
 servoValuesFileName = "lastServoValues"
+checkpointFileName = "lastPlayedStep"
+sharedMemoryFileName = "/dev/shm/robotServoState"
+
+# Shared memory layout: version counter, motion status, current pose, target pose.
+# The version counter is odd while the controller writes, readers retry until they see the same even version before and after reading.
+# Several controller processes can run at the same time, so writers hold an exclusive lock on the segment while writing.
+
+sharedMemoryVersionFormat = "<I"
+sharedMemoryStateFormat = "<I{0}d{0}d".format(servoCount)
+sharedMemorySize = struct.calcsize(sharedMemoryVersionFormat) + struct.calcsize(sharedMemoryStateFormat)
+sharedMemory = None
+sharedMemoryFd = None
+sharedMemoryReadAttempts = 10
+statusIdle = 0
+statusMoving = 1
 
 # CLI-option variables
 
@@ -33,6 +51,12 @@ valueOption   = "Value"
 servosOption  = "Servos"
 fileOption    = "File"
 speedOption   = "Speed"
+realTimeOption = "RealTime"
+fromOption    = "From"
+toOption      = "To"
+reverseOption = "Reverse"
+resumeOption  = "Resume"
+sharedMemoryOption = "SharedMemory"
 optionPrefix  = "--"
 optionPostfix = "="
 methods = ["read","write"]
@@ -41,10 +65,24 @@ arguments = [servoOption  + optionPostfix,
              valueOption  + optionPostfix,
              servosOption + optionPostfix,
              fileOption   + optionPostfix,
-             speedOption  + optionPostfix]
+             speedOption  + optionPostfix,
+             realTimeOption + optionPostfix,
+             fromOption   + optionPostfix,
+             toOption     + optionPostfix,
+             reverseOption,
+             resumeOption,
+             sharedMemoryOption + optionPostfix]
 
 useSmooth = True
 
+# Real-time variables
+
+useRealTime = False
+realTimePriority = 50 # SCHED_FIFO priority, above geth and node which run as SCHED_OTHER
+framePeriod = 0.02 # One PWM period at 50Hz. Writing servo pulses faster than that has no visible effect
+smoothStep = 0.006 # Good value for when both, geth and OPCUA-Server are running. Needs to be adjusted depending how much stressed the CPU is, tough
+missedDeadlines = 0
+
 # Option descriptions
 
 servoOptionDesc  = "Which servo the selecte method should be applied to. Valid values: 1-6."
@@ -53,6 +91,12 @@ valueOptionDesc  = "Which value to write to the selected servo. Only used with t
 servosOptionDesc = "A list of comma separated float-values that get assigned to the servo that corresponds the position in the list. If this option gets used, all other given options are getting ignored with exception of the {0}-option".format(fileOption)
 fileOptionDesc   = "Path to a file that stores a previous recorded set of values that the robot arms execute step by step. If this option gets used, all other given options are getting ignored."
 speedOptionDesc  = "Value that determines the speed for the robotarm movement. Valid values: {0}".format(range(0, len(speeds)))
+realTimeOptionDesc = "Enables the real-time mode for the arm movement and pins the process to the given CPU core. Raises the scheduling priority where permitted and plays the smooth movement frame by frame with a fixed deadline. One frame is played per PWM period, so every smooth movement takes about {0:.1f} seconds, independent of the --{1}-option. Use -1 to skip the CPU pinning. Valid values: -1 or a CPU core the process is allowed to run on.".format(framePeriod / smoothStep, speedOption)
+fromOptionDesc   = "First step of the recording to play. Only used with the --{0}-option. Steps are counted from 1.".format(fileOption)
+toOptionDesc     = "Last step of the recording to play. Only used with the --{0}-option. Defaults to the last step of the recording.".format(fileOption)
+reverseOptionDesc = "Plays the steps of the recording backwards, from the --{0}-step to the --{1}-step. Only used with the --{2}-option.".format(toOption, fromOption, fileOption)
+resumeOptionDesc = "Continues an interrupted playback of the recording after its last completed step, with the step range and direction of the interrupted playback. If there is a checkpoint, the --{1}-, --{2}- and --{3}-options are ignored. Only used with the --{0}-option.".format(fileOption, fromOption, toOption, reverseOption)
+sharedMemoryOptionDesc = "Path of the shared memory file the current servo state gets published to. Defaults to {0}.".format(sharedMemoryFileName)
 
 # Helper function, copied from the official instructions of the Joy-It-Robot02 instructions manual. Used to move the arm.
 def set_servo_pulse(channel, pulse, pwm):
@@ -125,37 +169,117 @@ def backToDefault():
     setServos(servos)
     writeServoFile(servos, servoValuesFileName)
     
-def playFile(fileName):
-    try:
+# Index a record-file. Returns the header values and the file offset of the first line of every step, so single steps can be read without parsing the whole file.
+def indexRecording(fileName):
+    offsets = []
+    with open(fileName, "rb") as file:
+        firstLine = file.readline().decode().split(",")
+        pauseBetweenServos = float(firstLine[0])
+        pauseBetweenSteps = float(firstLine[1])
+
         index = 0
-        firstLine = ""
-        pauseBetweenServos = 0
-        pauseBetweenSteps = 3
-        servos = []
-        
-        with open(fileName, "r") as file:
-            for line in file:
-                if firstLine == "":
-                    firstLine = line.split(",")
-                    print(firstLine)
-                    pauseBetweenServos = float(firstLine[0])
-                    pauseBetweenSteps = float(firstLine[1])
-                    continue
-                
-                servos.append(float(line))
-                index += 1
-            
-                if(index >= servoCount):
-                    setServos(servos, pauseBetweenServos)
-                    writeServoFile(servos, servoValuesFileName)
-                    time.sleep(pauseBetweenSteps)
-                    index = 0
-                    servos = []
+        offset = file.tell()
+        line = file.readline()
+        while line.strip() != b"":
+            if index % servoCount == 0:
+                offsets.append(offset)
+            index += 1
+            offset = file.tell()
+            line = file.readline()
+
+        # Drop an incomplete last step
+        if index % servoCount != 0:
+            offsets.pop()
+
+    return pauseBetweenServos, pauseBetweenSteps, offsets
+
+# Read the servo values of a single step from an opened record-file
+def readRecordingStep(file, offsets, step):
+    servos = []
+    file.seek(offsets[step])
+    for i in range(0, servoCount):
+        servos.append(float(file.readline().decode()))
 
-        backToDefault()
+    return servos
+
+# Read the last completed step of a playback. Returns None if there is no valid checkpoint for the given file.
+def readCheckpoint(fileName):
+    if not os.path.isfile(checkpointFileName):
+        return None
+
+    with open(checkpointFileName, "r") as file:
+        lines = file.read().split("\n")
+
+    if len(lines) < 4 or lines[0] != fileName:
+        return None
+
+    try:
+        completedStep, endStep, direction = int(lines[1]), int(lines[2]), int(lines[3])
+    except ValueError:
+        return None
+
+    if direction not in [1, -1]:
+        return None
+
+    return completedStep, endStep, direction
+
+# Save the last completed step of a playback, together with the step the playback is heading to.
+# Written to a temporary file first and then renamed, so a kill during the write never leaves a partial checkpoint.
+def writeCheckpoint(fileName, step, lastStep, direction):
+    tempFileName = checkpointFileName + ".tmp"
+    with open(tempFileName, "w") as file:
+        file.write("{0}\n{1}\n{2}\n{3}".format(fileName, step, lastStep, direction))
+    os.replace(tempFileName, checkpointFileName)
+
+def clearCheckpoint():
+    if os.path.isfile(checkpointFileName):
+        os.remove(checkpointFileName)
+
+# Plays the steps firstStep to lastStep of a record-file. Steps are counted from 0, a negative lastStep means the last step of the file.
+# With reverse the steps are played from lastStep back to firstStep. If resume is set, the playback continues after the last
+# completed step of a previous playback of the same file, in the same direction.
+# The arm only returns to the default position if the playback reached the end of the recording.
+def playFile(fileName, firstStep=0, lastStep=-1, reverse=False, resume=False):
+    try:
+        pauseBetweenServos, pauseBetweenSteps, offsets = indexRecording(fileName)
+        stepCount = len(offsets)
+        if firstStep >= stepCount:
+            print("Invalid step range. {0} has {1} steps".format(fileName, stepCount))
+            return
+
+        if lastStep < 0 or lastStep >= stepCount:
+            lastStep = stepCount - 1
+
+        if reverse:
+            step, endStep, direction = lastStep, firstStep, -1
+        else:
+            step, endStep, direction = firstStep, lastStep, 1
+
+        checkpoint = readCheckpoint(fileName) if resume else None
+        if checkpoint is not None:
+            if firstStep != 0 or lastStep != stepCount - 1 or reverse:
+                print("Resuming {0}, the given step range and direction are ignored".format(fileName))
+            completedStep, endStep, direction = checkpoint
+            step = completedStep + direction
+            print("Resume {0} at step {1}".format(fileName, step + 1))
+        elif resume:
+            print("No valid checkpoint for {0}, playing from step {1}".format(fileName, step + 1))
+
+        with open(fileName, "rb") as file:
+            while 0 <= step < stepCount and (step - endStep) * direction <= 0:
+                servos = readRecordingStep(file, offsets, step)
+                setServos(servos, pauseBetweenServos)
+                writeServoFile(servos, servoValuesFileName)
+                writeCheckpoint(fileName, step, endStep, direction)
+                step += direction
+                time.sleep(pauseBetweenSteps)
+
+        clearCheckpoint()
+        if endStep == (0 if direction < 0 else stepCount - 1):
+            backToDefault()
     except IOError as ioe:
         backToDefault()
-        print("IOError {0} while trying to read file: {1}".format(ioe.errno, e.strerror))
+        print("IOError {0} while trying to read file: {1}".format(ioe.errno, ioe.strerror))
         raise ioe
     except Exception as e:
         backToDefault()
@@ -177,12 +301,133 @@ def someMath(x):
      result = (-math.cos(x*math.pi)+1)/2
      return result
 
+# Raise scheduling priority and pin the process to a CPU core, so geth and the OPCUA-Server can't steal time from the arm movement.
+# Every step is optional, if the system does not permit it the movement runs with normal priority.
+def enableRealTime(cpu):
+    global useRealTime
+
+    useRealTime = True
+
+    if cpu >= 0:
+        try:
+            os.sched_setaffinity(0, [cpu])
+        except (AttributeError, OSError, ValueError) as e:
+            print("Unable to pin process to CPU {0}: {1}".format(cpu, e))
+
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(realTimePriority))
+    except (AttributeError, OSError) as e:
+        print("Unable to set real-time scheduling: {0}. Trying to raise niceness instead.".format(e))
+        try:
+            os.nice(-10)
+        except OSError as e:
+            print("Unable to raise niceness: {0}".format(e))
+
+# Sleep until the given absolute deadline. Returns False and counts the deadline as missed if it has already passed.
+def sleepUntil(deadline):
+    global missedDeadlines
+
+    remaining = deadline - time.monotonic()
+    if remaining < 0:
+        missedDeadlines += 1
+        return False
+
+    time.sleep(remaining)
+    return True
+
+# Print how many deadlines have been missed since missedBefore, if any
+def printMissedDeadlines(missedBefore):
+    if missedDeadlines > missedBefore:
+        print("Missed deadlines: {0} (total {1})".format(missedDeadlines - missedBefore, missedDeadlines))
+
+# CPU cores this process is allowed to run on
+def availableCpus():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(0, os.cpu_count() or 1))
+
+# Open the shared memory segment the current servo state gets published to. Creates it, if it does not exist yet.
+def openSharedMemory():
+    global sharedMemory
+    global sharedMemoryFd
+
+    try:
+        fd = os.open(sharedMemoryFileName, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < sharedMemorySize:
+                os.ftruncate(fd, sharedMemorySize)
+            sharedMemory = mmap.mmap(fd, sharedMemorySize)
+        except (OSError, ValueError):
+            os.close(fd)
+            raise
+        sharedMemoryFd = fd # Kept open for locking
+    except (OSError, ValueError) as e:
+        print("Unable to open shared memory {0}: {1}".format(sharedMemoryFileName, e))
+
+# Publish the current and target pose and the motion status to the shared memory segment
+def writeSharedMemory(current, target, status):
+    if sharedMemory is None:
+        return
+
+    fcntl.flock(sharedMemoryFd, fcntl.LOCK_EX)
+    try:
+        version = struct.unpack_from(sharedMemoryVersionFormat, sharedMemory, 0)[0]
+        writing = (version + 1) | 1 # Also recovers from an odd version left by an interrupted write
+        offset = struct.calcsize(sharedMemoryVersionFormat)
+        struct.pack_into(sharedMemoryVersionFormat, sharedMemory, 0, writing & 0xFFFFFFFF)
+        struct.pack_into(sharedMemoryStateFormat, sharedMemory, offset, status, *(list(current) + list(target)))
+        struct.pack_into(sharedMemoryVersionFormat, sharedMemory, 0, ((writing + 1) & 0xFFFFFFFF) or 2) # 0 means nothing published yet
+    finally:
+        fcntl.flock(sharedMemoryFd, fcntl.LOCK_UN)
+
+# Read the current pose, target pose and motion status from the shared memory segment.
+# Returns None if the segment is not available, or no consistent state could be read, e.g. because a writer got killed while writing.
+def readSharedMemory():
+    if sharedMemory is None:
+        return None
+
+    offset = struct.calcsize(sharedMemoryVersionFormat)
+    for attempt in range(0, sharedMemoryReadAttempts):
+        before = struct.unpack_from(sharedMemoryVersionFormat, sharedMemory, 0)[0]
+        if before == 0:
+            return None # Nothing published yet
+        if before % 2 == 1:
+            continue
+
+        state = struct.unpack_from(sharedMemoryStateFormat, sharedMemory, offset)
+        after = struct.unpack_from(sharedMemoryVersionFormat, sharedMemory, 0)[0]
+        if before == after:
+            return list(state[1:servoCount+1]), list(state[servoCount+1:]), state[0]
+
+    return None
+
 def setServos(newServos, pauseBetweenServos=0):
     if useSmooth:
         setServosSmooth(newServos, pauseBetweenServos)
     else:
         setServosRigid(newServos, pauseBetweenServos)
 
+    writeSharedMemory(newServos, newServos, statusIdle)
+
+# Play precalculated positions with one position per frame. Every frame has an absolute deadline relative to the start of the movement,
+# so a late frame does not delay the following ones. If frames are missed, the arm skips ahead to the position that belongs to the current time.
+def playPositionsRealTime(positions, target, pwm):
+    startTime = time.monotonic()
+    missedBefore = missedDeadlines
+    index = 0
+
+    while index < len(positions):
+        for i in range(0, servoCount):
+            set_servo_pulse(i, positions[index][i], pwm)
+        writeSharedMemory(positions[index], target, statusMoving)
+
+        index += 1
+        if not sleepUntil(startTime + index * framePeriod):
+            index = max(index, int((time.monotonic() - startTime) / framePeriod))
+
+    printMissedDeadlines(missedBefore)
+
 # Move robot arm in a smooth way
 def setServosSmooth(newServos, pauseBetweenServos=0):
     # Initialisierung mit alternativer Adresse
@@ -211,13 +456,17 @@ def setServosSmooth(newServos, pauseBetweenServos=0):
             newPositions[index].append(newPosition)
 
         index += 1
-        x += 0.006 # Good value for when both, geth and OPCUA-Server are running. Needs to be adjusted depending how much stressed the CPU is, tough
+        x += smoothStep
 
     # Play precalculated positions
-    for position in newPositions:
-        for i in range(0, servoCount):
-            set_servo_pulse(i, position[i], pwm)
-            #time.sleep(0.0001)
+    if useRealTime:
+        playPositionsRealTime(newPositions, newServos, pwm)
+    else:
+        for position in newPositions:
+            for i in range(0, servoCount):
+                set_servo_pulse(i, position[i], pwm)
+                #time.sleep(0.0001)
+            writeSharedMemory(position, newServos, statusMoving)
 
     # Set final new position
     for i in range(0, servoCount):
@@ -239,6 +488,7 @@ def setServosRigid(newServos, pauseBetweenServos=0):
     diff = []
     value = []
     sig = []
+    current = list(servos)
     
     for i in range(0, servoCount):
         diff.append(newServos[i] - servos[i])
@@ -247,16 +497,30 @@ def setServosRigid(newServos, pauseBetweenServos=0):
         if(diff[i] < 0):
             sig[i] = -1
 
+    deadline = time.monotonic()
+    missedBefore = missedDeadlines
     while 1 in sig or -1 in sig:
         for i in range(0, servoCount):
             value[i] += steps
             if value[i] < diff[i]*sig[i]:
-               set_servo_pulse(i, servos[i] + value[i]*sig[i], pwm)
+               current[i] = servos[i] + value[i]*sig[i]
             else:
-               set_servo_pulse(i, newServos[i], pwm)
+               current[i] = newServos[i]
                sig[i] = 0
-               
-        time.sleep(sleep)
+            set_servo_pulse(i, current[i], pwm)
+        writeSharedMemory(current, newServos, statusMoving)
+
+        if useRealTime:
+            # Without a pause there is no deadline to keep. After a missed deadline, continue from now instead of trying to catch up without sleeping
+            if sleep > 0:
+                deadline += sleep
+                if not sleepUntil(deadline):
+                    deadline = time.monotonic()
+        else:
+            time.sleep(sleep)
+
+    if useRealTime:
+        printMissedDeadlines(missedBefore)
         
 # Check for valid command line arguments
 def validArguments(selectedServo, method, value):
@@ -268,19 +532,25 @@ def validArguments(selectedServo, method, value):
 
 # Print useage of command lines
 def printUsage():
-    usage = "{0}\t{1}\n{2}\t{3}\n{4}\t{5}\n{6}\t{7}\n{8}\t{9}\n{10}\t{11}".format(servoOption, servoOptionDesc, methodOption, methodOptionDesc, valueOption, valueOptionDesc, servosOption, servosOptionDesc, fileOption, fileOptionDesc, speedOption, speedOptionDesc)
+    usage = "{0}\t{1}\n{2}\t{3}\n{4}\t{5}\n{6}\t{7}\n{8}\t{9}\n{10}\t{11}\n{12}\t{13}\n{14}\t{15}\n{16}\t{17}\n{18}\t{19}\n{20}\t{21}\n{22}\t{23}".format(servoOption, servoOptionDesc, methodOption, methodOptionDesc, valueOption, valueOptionDesc, servosOption, servosOptionDesc, fileOption, fileOptionDesc, speedOption, speedOptionDesc, realTimeOption, realTimeOptionDesc, fromOption, fromOptionDesc, toOption, toOptionDesc, reverseOption, reverseOptionDesc, resumeOption, resumeOptionDesc, sharedMemoryOption, sharedMemoryOptionDesc)
     print(usage)
     
 def main(argv):
 
     global servos
     global selectedSpeed
+    global sharedMemoryFileName
 
     servos = getServoValues()
     selectedServo = 0;
     method = ""
     value = 0
     fileName = ""
+    firstStep = 0
+    lastStep = -1
+    toUsed = False
+    reverse = False
+    resume = False
     
     fileUsed = False
     servosUsed = False
@@ -319,18 +589,46 @@ def main(argv):
                     print ("Invalid Speednumber. Must in {0}".format(range(0, len(speeds))))
                     printUsage()
                     exit(1)
+            if opt == optionPrefix + realTimeOption:
+                cpu = int(arg)
+                cpus = availableCpus()
+                if cpu != -1 and cpu not in cpus:
+                    print ("Invalid CPU core. Must be -1 or in {0}".format(cpus))
+                    printUsage()
+                    exit(1)
+                enableRealTime(cpu)
+            if opt == optionPrefix + fromOption:
+                firstStep = int(arg) - 1
+            if opt == optionPrefix + toOption:
+                toUsed = True
+                lastStep = int(arg) - 1
+            if opt == optionPrefix + reverseOption:
+                reverse = True
+            if opt == optionPrefix + resumeOption:
+                resume = True
+            if opt == optionPrefix + sharedMemoryOption:
+                sharedMemoryFileName = arg
             if opt == "-h":
                 printUsage()
                 exit(0)
 
+        openSharedMemory()
+
         if fileUsed:
-            playFile(fileName)
+            if firstStep < 0 or (toUsed and lastStep < firstStep):
+                print("Invalid step range")
+                printUsage()
+                exit(1)
+            playFile(fileName, firstStep, lastStep, reverse, resume)
         elif servosUsed:
             setServos(servos)
             writeServoFile(servos, servoValuesFileName)
         elif validArguments(selectedServo, method, value):
             writeHistoryFile(selectedServo, method, value, "robotHistory")
             if method == methods[0]:
+                state = readSharedMemory()
+                if state is not None:
+                    servos = state[0]
                 print(servos[selectedServo-1])
             elif method == methods[1]:
                 servos[selectedServo-1] = value
@@ -20,6 +20,8 @@ var webSocketUriOption = "webSocketUri";
 var servoCountOption = "servoCount";
 var printPythonConsoleOption = "printPythonConsole";
 var historyFileOption = "historyFile";
+var sharedMemoryOption = "sharedMemory";
+var realTimeOption = "realTime";
 
 // OPCUA-Eventnames
 var opcua_post_initialize = "post_initialize";
@@ -50,6 +52,7 @@ var whisperTopic;
 // Python-Variables
 var pythonScript;
 var printPythonConsole;
+var realTimeCpu;
 var pythonOptions = {
     mode: "text",
     pythonOptions: ["-u"],
@@ -68,6 +71,14 @@ var session;
 // History file name
 var historyFileName;
 
+// Shared-Memory-Variables
+// Layout written by the controller software: UInt32 version, UInt32 motion status, Double current pose, Double target pose. All little endian.
+// The version is odd while the controller writes.
+var sharedMemoryFileName;
+var sharedMemoryFd;
+var sharedMemoryBuffer;
+var sharedMemoryVersionBuffer = Buffer.alloc(4);
+
 // Parsing Command-Line-Options
 var argv = yargs(process.argv)
     .wrap(80)
@@ -119,6 +130,15 @@ var argv = yargs(process.argv)
     .alias("h", historyFileOption)
     .default(historyFileOption, "robotOpcuaHistory")
 
+    .string(sharedMemoryOption)
+    .describe(sharedMemoryOption, "The shared memory file the python script publishes the servo state to. Gets passed to the python script. If it is not available, the servo values are requested from the python script.")
+    .alias("m", sharedMemoryOption)
+    .default(sharedMemoryOption, "/dev/shm/robotServoState")
+
+    .number(realTimeOption)
+    .describe(realTimeOption, "Runs the python script in its real-time mode, pinned to the given CPU core. Use -1 to skip the CPU pinning. Keeps the arm movement smooth while the ethereum-node is busy.")
+    .alias("r", realTimeOption)
+
     .version("1.0")
     .argv;
 
@@ -137,8 +157,60 @@ function updateServoValue(servoIndex){
     });
 }
 
-// Method, that updates all servo values of the OPCUA server by asking the controller software for each one individually.
+// Helper method, that closes the shared memory file, so it gets opened again on the next read.
+function closeSharedMemory(){
+    if(sharedMemoryFd !== undefined){
+	try{
+	    fs.closeSync(sharedMemoryFd);
+	}
+	catch(err){}
+	sharedMemoryFd = undefined;
+    }
+}
+
+// Helper method, that reads the current servo values from the shared memory of the controller software.
+// Returns false, if the shared memory is not available or nothing has been published yet.
+function readSharedServoValues(){
+    try{
+	// The shared memory file might have been removed and created again. Reading the old file would return frozen values.
+	if(sharedMemoryFd !== undefined && fs.fstatSync(sharedMemoryFd).ino != fs.statSync(sharedMemoryFileName).ino)
+	    closeSharedMemory();
+
+	if(sharedMemoryFd === undefined){
+	    sharedMemoryFd = fs.openSync(sharedMemoryFileName, "r");
+	    sharedMemoryBuffer = Buffer.alloc(8 + 16 * servoCount);
+	}
+
+	// Retry until the version before and after reading is the same and even, i.e. no write happened in between
+	for(var attempt = 0; attempt < 10; attempt++){
+	    fs.readSync(sharedMemoryFd, sharedMemoryBuffer, 0, sharedMemoryBuffer.length, 0);
+	    var version = sharedMemoryBuffer.readUInt32LE(0);
+	    if(version == 0)
+		return false;
+	    if(version % 2 == 1)
+		continue;
+
+	    fs.readSync(sharedMemoryFd, sharedMemoryVersionBuffer, 0, 4, 0);
+	    if(sharedMemoryVersionBuffer.readUInt32LE(0) != version)
+		continue;
+
+	    for(var i = 0; i < servoCount; i++)
+		servos[i] = sharedMemoryBuffer.readDoubleLE(8 + 8 * i);
+	    return true;
+	}
+    }
+    catch(err){
+	closeSharedMemory();
+    }
+    return false;
+}
+
+// Method, that updates all servo values of the OPCUA server. Uses the shared memory of the controller software if available,
+// otherwise asks the controller software for each one individually.
 function updateServoValues(){
+    if(readSharedServoValues())
+	return;
+
     for( var i = 0; i < servoCount; i++){
 	updateServoValue(i);
     }
@@ -152,7 +224,7 @@ function getServo(servoIndex){
 // Set servo value. Calls controllersoftware to set the physical servo to the given value.
 function setServo(servoIndex, servoValue){
     args = ["--Servo=" + (servoIndex+1), "--Method=write", "--Value=" + servoValue];
-    var script = runPythonScript(args);
+    var script = runPythonScript(movementArgs(args));
     return script;
 }
 
@@ -235,6 +307,53 @@ function opcuaServerPostInitialize(){
 	callback(null, callMethodResult);
     });
 
+    // Prepare adding method to play a part of a recording to OPCUA-Server
+    var rangeMethod = addressSpace.addMethod(robot, {
+	nodeId: "ns=1;s=playFileRange",
+	description: "Plays a range of steps of a recorded robot movement, forwards or backwards, or resumes an interrupted playback.",
+	browseName: "playFileRange",
+	inputArguments: [{
+	    name: "fileName",
+	    description: {text: "path to file to load and play."},
+	    dataType: DataType.String
+	},{
+	    name: "fromStep",
+	    description: {text: "first step to play, counted from 1. 0 for the first step of the recording."},
+	    dataType: DataType.UInt32
+	},{
+	    name: "toStep",
+	    description: {text: "last step to play, counted from 1. 0 for the last step of the recording."},
+	    dataType: DataType.UInt32
+	},{
+	    name: "reverse",
+	    description: {text: "true, if the steps should be played backwards."},
+	    dataType: DataType.Boolean
+	},{
+	    name: "resume",
+	    description: {text: "true, if an interrupted playback of the file should be continued after its last completed step."},
+	    dataType: DataType.Boolean
+	}],
+	outputArguments: []
+    });
+
+    //Add OPCUA-Method
+    rangeMethod.bindMethod(function(inputArguments, context, callback){
+	var callMethodResult = {
+	    statusCode: StatusCodes.Good,
+	    outputArguments:[]
+	};
+
+	var file = inputArguments[0].value;
+	var fromStep = inputArguments[1].value;
+	var toStep = inputArguments[2].value;
+	var reverse = inputArguments[3].value;
+	var resume = inputArguments[4].value;
+	logAndWrite("OPCUA: Command received to play file " + file + " from step " + fromStep + " to step " + toStep + ", reverse: " + reverse + ", resume: " + resume);
+	logAndWrite("OPCUA: Call pythonscript to load and play file");
+	playFile(file, fromStep, toStep, reverse, resume);
+	callback(null, callMethodResult);
+    });
+
     logAndWrite("OPCUA: Server successfully initialized.");
 
     initializeOpcuaClient();    
@@ -328,16 +447,37 @@ function onWhisperMessageReceived(error, message, subscription){
     sMessage = webSocket.utils.hexToString(message.payload);
     logAndWrite(("WHISPER: WhisperMessage received: " + sMessage).green);
     
+    // Command format: File=<fileName>[;From=<step>][;To=<step>][;Reverse][;Resume]
     if(sMessage.startsWith("File=") && sMessage.length > "File=".length){
 	logAndWrite(("WHISPER: Command received: " + sMessage).green);
-	file = sMessage.split("=")[1];
-	logAndWrite(("Call OPCUA-Method to load file " + file).green);
+	var parts = sMessage.split(";");
+	file = parts[0].split("=")[1];
+	var fromStep = 0;
+	var toStep = 0;
+	var reverse = false;
+	var resume = false;
+	for(var i = 1; i < parts.length; i++){
+	    if(parts[i].startsWith("From=")) fromStep = parseInt(parts[i].split("=")[1]) || 0;
+	    if(parts[i].startsWith("To=")) toStep = parseInt(parts[i].split("=")[1]) || 0;
+	    if(parts[i] == "Reverse") reverse = true;
+	    if(parts[i] == "Resume") resume = true;
+	}
+
 	var inputArgument = [{
 	    dataType: DataType.String,
 	    arrayType: VariantArrayType.Scalar, 
 	    value: file
 	}];
-	callOpcuaMethod("ns=1;s=loadFile", inputArgument, function(err, result){
+	var methodId = "ns=1;s=loadFile";
+	if(parts.length > 1){
+	    methodId = "ns=1;s=playFileRange";
+	    inputArgument.push({dataType: DataType.UInt32, arrayType: VariantArrayType.Scalar, value: fromStep});
+	    inputArgument.push({dataType: DataType.UInt32, arrayType: VariantArrayType.Scalar, value: toStep});
+	    inputArgument.push({dataType: DataType.Boolean, arrayType: VariantArrayType.Scalar, value: reverse});
+	    inputArgument.push({dataType: DataType.Boolean, arrayType: VariantArrayType.Scalar, value: resume});
+	}
+	logAndWrite(("Call OPCUA-Method to load file " + file).green);
+	callOpcuaMethod(methodId, inputArgument, function(err, result){
 	    if(err) logAndWrite(err.toString().red);
 	    else logAndWrite(result.toString().green);
 	});
@@ -421,15 +561,27 @@ function onPythonEnd(err, code, signal, script){
 }
 
 // Starts the python script with the cli --File=<fileName>. This should play a previously recorded file for the robot arm.
-function playFile(fileName){
+// fromStep and toStep are counted from 1, 0 or undefined plays from the first or to the last step of the recording.
+function playFile(fileName, fromStep, toStep, reverse, resume){
     // Starts the pythonscript with the --File= option
     args = ["--File=" + fileName];
-    runPythonScript(args);
+    if(fromStep > 0) args.push("--From=" + fromStep);
+    if(toStep > 0) args.push("--To=" + toStep);
+    if(reverse) args.push("--Reverse");
+    if(resume) args.push("--Resume");
+    runPythonScript(movementArgs(args));
+}
+
+// Adds the real-time option to the arguments of a python script call that moves the arm, if the real-time mode is enabled.
+function movementArgs(args){
+    if(realTimeCpu !== undefined)
+	return args.concat(["--RealTime=" + realTimeCpu]);
+    return args;
 }
 
 // Runs the python script with the given arguments.    
 function runPythonScript(args){
-    pythonOptions.args = args;
+    pythonOptions.args = args.concat(["--SharedMemory=" + sharedMemoryFileName]);
     
     var script = new PythonShell(pythonScript, pythonOptions);
     script.on(python_message, function(message){onPythonMessage(message, script)}); // Gets called when pythonscript prints something to console
@@ -466,6 +618,12 @@ function getCLIArguments(){
     whisperPassword = argv.whisperPassword;
     whisperTopic = argv.whisperTopic;
     historyFileName = argv.historyFile;
+    sharedMemoryFileName = argv.sharedMemory;
+    realTimeCpu = argv.realTime;
+    if(realTimeCpu !== undefined && !Number.isInteger(realTimeCpu)){
+	console.log("Invalid value for --" + realTimeOption + ". Must be a CPU core or -1.");
+	process.exit(-1);
+    }
 }
 
 // main method.